@@ -1,7 +1,12 @@
 """Support rolling stocktake for InvenTree"""
 
-from django.db.models import DateField, Min, F
-from django.db.models.functions import Cast, Coalesce
+import logging
+from datetime import timezone
+from functools import cache as memoize
+
+from django.core.cache import cache
+from django.db.models import Case, DateField, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Random, TruncDate
 from django.core.validators import MinValueValidator
 
 from plugin import InvenTreePlugin
@@ -16,6 +21,40 @@ from plugin.mixins import (
 
 from . import PLUGIN_VERSION
 
+logger = logging.getLogger(__name__)
+
+# Cached "daily limit reached" counts expire after five minutes
+DAILY_BUDGET_TIMEOUT = 60 * 5
+
+# Cached group membership checks expire after a minute
+GROUP_MEMBERSHIP_TIMEOUT = 60
+
+# Cached plugin settings (passed to the dashboard item) expire after a minute
+SETTINGS_DICT_TIMEOUT = 60
+
+# Events which are processed by this plugin
+WANTED_EVENTS = frozenset({
+    "part_part.created",
+})
+
+# Number of stock items fetched at a time, when streaming results from the database
+ITERATOR_CHUNK_SIZE = 500
+
+# Ordering of the items returned for the selected scope (requires the date annotations)
+SCOPE_ORDERING = ("oldest_date", "pk")
+
+
+@memoize
+def stocktake_filter() -> Q:
+    """Return the filter for stock items which are eligible for stocktake.
+
+    This is built once (on first use), as the StockItem model cannot be imported at module load.
+    """
+    from stock.models import StockItem
+
+    # "In stock" items which are not linked to inactive or virtual parts
+    return StockItem.IN_STOCK_FILTER & Q(part__active=True) & ~Q(part__virtual=True)
+
 
 class RollingStocktake(
     EventMixin,
@@ -84,122 +123,247 @@ class RollingStocktake(
         },
     }
 
-    def get_stock_items(self, user):
+    def get_stock_items(self, user, settings=None):
         """Return StockItem(s) which should be counted next by the given user.
 
-        Returns a list of items based on the STOCKTAKE_SCOPE setting:
+        Returns items based on the STOCKTAKE_SCOPE setting:
         - ITEM: Single oldest item
         - LOCATION: All items at the same location as the oldest item (same location only)
         - LOCATION_WITH_SUBLOCATIONS: All items at the same location as the oldest item (including sublocations)
         - ALL: All items of the same part as the oldest item
+
+        An iterator is returned (for every scope), with the oldest item first.
+        Items are streamed from the database in chunks, as a part may have many stock items.
+
+        Arguments:
+            user: The user who is performing the stocktake
+            settings: Optional snapshot of plugin settings (see settings_snapshot)
         """
 
-        from InvenTree.helpers import current_date
         from stock.models import StockItem
+        from stock.serializers import StockItemSerializer
 
-        # First, check if the user has already counted the maximum number of items today
-        daily_limit = int(self.get_setting("DAILY_LIMIT", backup_value=5))
-
-        if daily_limit > 0:
-            stocakes = StockItem.objects.filter(
-                stocktake_date=current_date(),
-                stocktake_user=user,
-            ).count()
+        if settings is None:
+            settings = self.settings_snapshot()
 
-            # Already reached the daily limit
-            if stocakes >= daily_limit:
-                return []
+        # First, check if the user has already counted the maximum number of items today
+        daily_limit = int(settings["DAILY_LIMIT"])
 
-        # Start with a list of "in stock" items
-        items = StockItem.objects.filter(StockItem.IN_STOCK_FILTER)
+        # Already reached the daily limit (a limit of zero means "unlimited")
+        if daily_limit > 0 and self._daily_limit_reached(user, daily_limit):
+            return iter(())
 
-        # Exclude items which are linked to inactive or virtual parts
-        items = items.filter(part__active=True).exclude(part__virtual=True)
+        # Start with a list of "in stock" items, excluding inactive or virtual parts
+        items = StockItem.objects.filter(stocktake_filter())
 
         # Optionally filter out items in external locations
-        if self.get_setting("IGNORE_EXTERNAL", backup_value=True):
+        if settings["IGNORE_EXTERNAL"]:
             items = items.exclude(location__external=True)
 
         # TODO: Filter items based on user subscriptions
 
-        # Annotate the "creation" date, based on the oldest StockItemHistory entry
-        items = items.annotate(
-            creation_date=Cast(Min("tracking_info__date"), output_field=DateField())
-        )
-
-        # For items which do not have a "stocktake" date, annotate the "creation" date
+        # Keep a reference to the un-annotated queryset, for fetching related items
+        base_items = items
 
-        items = items.annotate(
-            oldest_date=Coalesce(
-                F("stocktake_date"), F("creation_date"), output_field=DateField()
-            )
-        )
+        items = self._annotate_dates(items)
 
-        # TODO: Randomize the order of items which have the same stocktake date
+        # Randomize the order of items which have the same stocktake date
+        items = items.order_by("oldest_date", Random())
 
-        items = items.order_by("oldest_date")
+        # Get the oldest item (only fetching the fields required to find related items)
+        oldest_rows = items.values(
+            "pk",
+            "part_id",
+            "location_id",
+            "location__tree_id",
+            "location__lft",
+            "location__rght",
+            "stocktake_date",
+            "creation_date",
+        )[:1]
 
-        # Get the oldest item
-        oldest_item = items.first()
+        oldest_row = next(iter(oldest_rows), None)
 
-        if not oldest_item:
-            return []
+        if not oldest_row:
+            return iter(())
 
         # Get the scope setting
-        scope = self.get_setting("STOCKTAKE_SCOPE", backup_value="ITEM")
+        scope = settings["STOCKTAKE_SCOPE"]
 
-        if scope == "ITEM":
-            # Return only the single oldest item
-            return [oldest_item]
-        elif scope == "LOCATION":
-            # Return all items of the same part at the same location (same location only)
-            location = oldest_item.location
+        part_id = oldest_row["part_id"]
+        location_id = oldest_row["location_id"]
 
-            if location:
+        if scope == "LOCATION":
+            # Return all items of the same part at the same location (same location only)
+            if location_id:
                 # Filter items by the same part and location (exact location only)
-                location_items = items.filter(part=oldest_item.part, location=location)
+                scope_items = base_items.filter(
+                    part_id=part_id, location_id=location_id
+                )
             else:
                 # If no location, return items without location for the same part
-                location_items = items.filter(
-                    location__isnull=True, part=oldest_item.part
-                )
-            return list(location_items)
+                scope_items = base_items.filter(location__isnull=True, part_id=part_id)
         elif scope == "LOCATION_WITH_SUBLOCATIONS":
             # Return all items of the same part at the same location (including sublocations)
-            location = oldest_item.location
-
-            if location:
+            if location_id:
                 # Filter items by the same part and location (including sublocations)
-                location_items = items.filter(
-                    part=oldest_item.part,
-                    location__in=location.get_descendants(include_self=True),
+                # Use the MPTT tree range directly, rather than a list of descendant locations
+                scope_items = base_items.filter(
+                    part_id=part_id,
+                    location__tree_id=oldest_row["location__tree_id"],
+                    location__lft__gte=oldest_row["location__lft"],
+                    location__lft__lte=oldest_row["location__rght"],
                 )
             else:
                 # If no location, return items without location for the same part
-                location_items = items.filter(
-                    location__isnull=True, part=oldest_item.part
-                )
-            return list(location_items)
+                scope_items = base_items.filter(location__isnull=True, part_id=part_id)
         elif scope == "ALL":
             # Return all items of the same part
-            part_items = items.filter(part=oldest_item.part)
-            return list(part_items)
+            scope_items = base_items.filter(part_id=part_id)
         else:
-            # Default to single item
-            return [oldest_item]
+            # Return only the single oldest item (default)
+            scope_items = base_items.filter(pk=oldest_row["pk"])
+
+        # Annotate dates for ordering by age (the subquery is cheap on this smaller set)
+        scope_items = self._annotate_dates(scope_items)
+
+        # Fetch related data up front, as required by the StockItemSerializer
+        scope_items = StockItemSerializer.annotate_queryset(scope_items)
+
+        return self._iter_oldest_first(scope_items, oldest_row)
+
+    def _annotate_dates(self, items):
+        """Annotate the "creation" and "oldest" dates onto the provided StockItem queryset."""
+        from stock.models import StockItemTracking
+
+        # Annotate the "creation" date, based on the oldest StockItemTracking entry
+        # A correlated subquery avoids the GROUP BY which an aggregate over the reverse relation requires
+        # The date is truncated within the subquery, so only the selected row is converted
+        # (in UTC, matching the previous CAST to a date on the database connection)
+        first_tracking_date = (
+            StockItemTracking.objects
+            .filter(item_id=OuterRef("pk"))
+            .order_by("date")
+            .values(first_date=TruncDate("date", tzinfo=timezone.utc))[:1]
+        )
+
+        items = items.annotate(
+            creation_date=Subquery(first_tracking_date, output_field=DateField())
+        )
+
+        # For items which do not have a "stocktake" date, annotate the "creation" date
+        return items.annotate(
+            oldest_date=Coalesce(
+                F("stocktake_date"), F("creation_date"), output_field=DateField()
+            )
+        )
+
+    def settings_snapshot(self) -> dict:
+        """Return the values of all plugin settings, read once for the current request.
+
+        Values are read via get_setting, so type conversion and defaults follow
+        each setting's definition in SETTINGS.
+        """
+        return {
+            key: self.get_setting(key, backup_value=options.get("default"))
+            for key, options in self.SETTINGS.items()
+        }
+
+    def _dashboard_context_settings(self) -> dict:
+        """Return the settings dict passed to the dashboard item, cached briefly between renders.
+
+        This is only used for the dashboard context payload (never for permission checks).
+        """
+        key = "rs:settings_dict"
+        settings = cache.get(key)
+
+        if settings is None:
+            settings = self.get_settings_dict()
+            cache.set(key, settings, timeout=SETTINGS_DICT_TIMEOUT)
+
+        return settings
+
+    def _iter_oldest_first(self, items, oldest_row):
+        """Yield the provided items, with the oldest item first (followed by SCOPE_ORDERING).
+
+        The view reads the stocktake and creation dates from the first item.
+        Items are streamed from the database in chunks, rather than loaded into memory at once.
+        """
+        items = items.order_by(
+            Case(When(pk=oldest_row["pk"], then=Value(0)), default=Value(1)),
+            *SCOPE_ORDERING,
+        )
+
+        yield from items.iterator(chunk_size=ITERATOR_CHUNK_SIZE)
+
+    def user_in_group(self, user, group) -> bool:
+        """Return True if the given user is a member of the specified group.
+
+        The result is cached for GROUP_MEMBERSHIP_TIMEOUT seconds, so changes to
+        group membership may take up to that long to be applied (per worker,
+        if the cache is not shared between processes).
+        """
+        key = f"rs:grp:{user.pk}:{group}"
+        result = cache.get(key)
+
+        if result is None:
+            result = user.groups.filter(pk=group).exists()
+            cache.set(key, result, timeout=GROUP_MEMBERSHIP_TIMEOUT)
+
+        return result
+
+    def _daily_budget_key(self, user) -> str:
+        """Return the cache key for the number of items counted by a user today."""
+        from InvenTree.helpers import current_date
+
+        return f"rolling_stocktake:{user.pk}:{current_date():%Y%m%d}"
+
+    def _daily_limit_reached(self, user, daily_limit: int) -> bool:
+        """Return True if the given user has counted at least daily_limit items today.
+
+        The database count is the source of truth, and is queried on every call
+        until the limit is reached. Only a count which has reached the limit is
+        cached (briefly), so polling after the limit does not re-run the query.
+
+        The cached value can over-report: if another user recounts an item,
+        the stocktake_user is overwritten and the real count drops. In that case
+        the user remains blocked until the cache entry expires (DAILY_BUDGET_TIMEOUT).
+        Raising the limit is picked up immediately, as a cached count below the
+        new limit is ignored.
+        """
+        from InvenTree.helpers import current_date
+        from stock.models import StockItem
+
+        key = self._daily_budget_key(user)
+        count = cache.get(key)
+
+        if count is not None and count >= daily_limit:
+            return True
+
+        count = StockItem.objects.filter(
+            stocktake_date=current_date(),
+            stocktake_user=user,
+        ).count()
+
+        if count < daily_limit:
+            return False
+
+        cache.set(key, count, timeout=DAILY_BUDGET_TIMEOUT)
+
+        return True
 
     # Respond to InvenTree events (from EventMixin)
     # Ref: https://docs.inventree.org/en/latest/plugins/mixins/event/
     def wants_process_event(self, event: str) -> bool:
         """Return True if the plugin wants to process the given event."""
         # Example: only process the 'create part' event
-        return event == "part_part.created"
+        return event in WANTED_EVENTS
 
     def process_event(self, event: str, *args, **kwargs) -> None:
         """Process the provided event."""
-        print("Processing custom event:", event)
-        print("Arguments:", args)
-        print("Keyword arguments:", kwargs)
+        logger.debug(
+            "Processing custom event=%s args=%s kwargs=%s", event, args, kwargs
+        )
 
     # Custom URL endpoints (from UrlsMixin)
     # Ref: https://docs.inventree.org/en/latest/plugins/mixins/urls/
@@ -212,7 +376,7 @@ class RollingStocktake(
             # Provide path to a simple custom view - replace this with your own views
             path(
                 "next/",
-                RollingStocktakeView.as_view(),
+                RollingStocktakeView.as_view(plugin=self),
                 name="api-rolling-stocktake-view",
             ),
         ]
@@ -225,13 +389,11 @@ class RollingStocktake(
         if not request.user or not request.user.is_authenticated:
             return []
 
-        # Check if the user is in the allowed group (if configured)
+        # Only show widget to users in the allowed group (if configured)
         user_group = self.get_setting("USER_GROUP")
 
-        if user_group and user_group != "":
-            # Only show widget to users in the allowed group
-            if not request.user.groups.filter(pk=user_group).exists():
-                return []
+        if user_group and not self.user_in_group(request.user, user_group):
+            return []
 
         items = []
 
@@ -244,7 +406,7 @@ class RollingStocktake(
                 "Dashboard.js:renderRollingStocktakeDashboardItem"
             ),
             "context": {
-                "settings": self.get_settings_dict(),
+                "settings": self._dashboard_context_settings(),
             },
         })
 
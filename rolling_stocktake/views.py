@@ -5,6 +5,8 @@ In practice, you would define your custom views here.
 Ref: https://www.django-rest-framework.org/api-guide/views/
 """
 
+from itertools import chain
+
 from rest_framework import permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -31,19 +33,23 @@ class RollingStocktakeView(APIView):
     # Control how the response is formatted
     serializer_class = RollingStocktakeSerializer
 
+    # The plugin instance which registered this view (provided via as_view)
+    plugin = None
+
     def get(self, request, *args, **kwargs):
         """Override the GET method to return stock items for stocktake."""
 
-        from plugin import registry
+        rolling_stocktake_plugin = self.plugin
 
-        rolling_stocktake_plugin = registry.get_plugin("rolling-stocktake")
+        # Fetch all plugin settings at once
+        settings = rolling_stocktake_plugin.settings_snapshot()
 
         # Check if the user is in the allowed group (if configured)
-        user_group = rolling_stocktake_plugin.get_setting("USER_GROUP")
+        user_group = settings["USER_GROUP"]
 
         if user_group:
             # Check if the user is a member of the required group
-            if not request.user.groups.filter(pk=user_group).exists():
+            if not rolling_stocktake_plugin.user_in_group(request.user, user_group):
                 # User is not in the allowed group - return empty response
                 return Response(
                     {
@@ -55,21 +61,32 @@ class RollingStocktakeView(APIView):
                     status=403,
                 )
 
-        stock_items = rolling_stocktake_plugin.get_stock_items(request.user)
+        stock_items = rolling_stocktake_plugin.get_stock_items(
+            request.user, settings=settings
+        )
+
+        # Items are returned as an iterator, so peek at the first (oldest) item
+        oldest_item = next(stock_items, None)
+
+        if oldest_item is None:
+            # Nothing to count - no need to run the serializer
+            return Response(
+                {
+                    "items": [],
+                    "stocktake_date": None,
+                    "creation_date": None,
+                },
+                status=200,
+            )
 
         # Get the oldest item's dates for backward compatibility
         # These dates are passed directly to the serializer and will be included in the response
-        oldest_item = stock_items[0] if stock_items else None
-        stocktake_date = (
-            getattr(oldest_item, "stocktake_date", None) if oldest_item else None
-        )
-        creation_date = (
-            getattr(oldest_item, "creation_date", None) if oldest_item else None
-        )
+        stocktake_date = getattr(oldest_item, "stocktake_date", None)
+        creation_date = getattr(oldest_item, "creation_date", None)
 
         response_serializer = self.serializer_class(
             instance={
-                "items": stock_items,
+                "items": chain([oldest_item], stock_items),
                 "stocktake_date": stocktake_date,
                 "creation_date": creation_date,
             }